@@ -0,0 +1,146 @@
+"""asyncio counterparts of DBMigrate and the migration engines (python 3)"""
+import asyncio
+import collections
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from deebeemigrate.core import MigrationSteps, directory_migrations
+from deebeemigrate.dbengines import DatabaseMigrationEngine, SQLException
+
+
+logger = logging.getLogger(__name__)
+
+
+MigrationEvent = collections.namedtuple('MigrationEvent', 'kind filename detail')
+
+
+class AsyncEngine(object):
+    """wraps a migration engine so its methods can be awaited
+
+    Every call runs on an executor thread dedicated to the connection so
+    the event loop is never blocked and connections that are bound to
+    the thread that opened them (sqlite) keep working."""
+
+    def __init__(self, connection_string):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connected = self.executor.submit(
+            DatabaseMigrationEngine.connect, connection_string)
+
+    async def run(self, func, *args):
+        engine = await asyncio.wrap_future(self.connected)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: func(engine, *args))
+
+    async def execute(self, statement):
+        # cursors can't leave the executor thread so nothing is returned
+        def execute(engine):
+            engine.execute(statement)
+        await self.run(execute)
+
+    async def results(self, statement):
+        return await self.run(lambda engine: engine.results(statement))
+
+    async def create_migration_table(self):
+        await self.run(lambda engine: engine.create_migration_table())
+
+    async def performed_migrations(self):
+        return await self.run(lambda engine: engine.performed_migrations)
+
+    async def rename_migrations(self, renames):
+        return await self.run(
+            lambda engine: engine.rename_migrations(renames))
+
+    async def sql(self, directory, filename, sha1_hash):
+        return await self.run(
+            lambda engine: engine.sql(directory, filename, sha1_hash))
+
+    async def close(self):
+        try:
+            await self.run(lambda engine: engine.close())
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+class AsyncDBMigrate(MigrationSteps):
+    """DBMigrate for asyncio services
+
+    migrate() is an async iterator of MigrationEvents so progress can be
+    reported while the event loop keeps serving other requests:
+
+        async with AsyncDBMigrate(...) as dbmigrate:
+            async for event in dbmigrate.migrate():
+                logger.info('%s %s', event.kind, event.filename)
+    """
+
+    def __init__(self,
+                 out_of_order,
+                 dry_run,
+                 connection_string,
+                 directory,
+                 run_for_new_db):
+        self.out_of_order = out_of_order
+        self.dry_run = dry_run
+        self.engine = AsyncEngine(connection_string)
+        self.directory = directory
+        self.run_for_new_db = run_for_new_db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.engine.close()
+
+    async def migration_plan(self, current_migrations=None,
+                             missing_table_ok=True):
+        """returns the MigrationPlan for the current migrations (the
+        directory by default) and the database"""
+        if current_migrations is None:
+            loop = asyncio.get_running_loop()
+            current_migrations = await loop.run_in_executor(
+                None, directory_migrations, self.directory)
+        try:
+            performed_migrations = await self.engine.performed_migrations()
+        except SQLException as e:
+            performed_migrations = self.unread_migration_table(
+                e, missing_table_ok)
+        return self.plan_for(current_migrations, performed_migrations)
+
+    async def migrate(self):
+        """migrate a database to the current schema, yielding a
+        MigrationEvent for each step"""
+        loop = asyncio.get_running_loop()
+        new_db = False
+        if not self.dry_run:
+            try:
+                await self.engine.create_migration_table()
+            except SQLException:
+                pass
+            else:
+                new_db = True
+                yield MigrationEvent('created_table', None, None)
+        plan = await self.migration_plan(missing_table_ok=self.dry_run)
+        warnings = []
+        files_sha1s_to_run = self.migrations_to_run(plan, warnings.append)
+        for warning in warnings:
+            yield MigrationEvent('warning', None, warning)
+
+        for filename, sha1_hash in files_sha1s_to_run:
+            migration_info = await self.engine.sql(
+                self.directory, filename, sha1_hash)
+            if self.dry_run:
+                yield MigrationEvent('planned', filename, str(migration_info))
+                continue
+            if not self.simulate(new_db):
+                if migration_info.command:
+                    await loop.run_in_executor(
+                        None, subprocess.check_call, migration_info.command)
+                if migration_info.migration_sql:
+                    await self.engine.execute(migration_info.migration_sql)
+                kind = 'applied'
+            else:
+                kind = 'simulated'
+            await self.engine.execute(migration_info.migration_info_sql)
+            yield MigrationEvent(kind, filename, None)
+
+        yield MigrationEvent('done', None, len(files_sha1s_to_run))
@@ -2,6 +2,8 @@ import os
 import sys
 import subprocess
 import logging
+import threading
+import time
 from hashlib import sha1
 from optparse import OptionParser
 from datetime import datetime
@@ -11,48 +13,86 @@ from deebeemigrate.dbengines import (DatabaseMigrationEngine,
                                      FilenameSha1,
                                      SQLException)
 from deebeemigrate.command import command
+from deebeemigrate.plan import (MigrationPlan,
+                                OutOfOrderException,
+                                ModifiedMigrationException)
+from deebeemigrate.watch import MigrationWatcher
 
 
 logger = logging.getLogger(__name__)
 
 
-class OutOfOrderException(Exception):
-    pass
+def blobsha1(filename):
+    """returns the git sha1sum of a file so the exact migration
+    that was run can easily be looked up in the git history"""
+    text = open(filename).read()
+    s = sha1(("blob %u\0" % len(text)).encode('UTF-8'))
+    s.update(text.encode('UTF-8'))
+    return s.hexdigest()
 
 
-class ModifiedMigrationException(Exception):
-    pass
+def directory_migrations(directory):
+    """returns the migration files in directory as a list of
+       (filename, sha1sum) tuples"""
+    return [
+        FilenameSha1(os.path.basename(filename), blobsha1(filename))
+        for filename in glob(os.path.join(directory, '*'))]
 
 
-class DBMigrate(object):
+class MigrationSteps(object):
+    """The decisions migrate makes, shared by DBMigrate and
+    deebeemigrate.aio.AsyncDBMigrate which only differ in how they talk
+    to the database. Subclasses set out_of_order and run_for_new_db."""
+
+    def plan_for(self, current_migrations, performed_migrations):
+        return MigrationPlan(current_migrations, performed_migrations)
+
+    def unread_migration_table(self, error, missing_table_ok):
+        """returns the performed migrations to plan with when the
+        migration table couldn't be read, re-raising error unless a
+        missing table is ok (dry runs and plan)"""
+        if not missing_table_ok:
+            raise error
+        # no migration table yet
+        return []
+
+    def migrations_to_run(self, plan, warn):
+        return plan.check(self.out_of_order, warn)
+
+    def simulate(self, new_db):
+        """whether migrations are only recorded instead of run because
+        the migration table was just created"""
+        return new_db and not self.run_for_new_db
+
+
+class DBMigrate(MigrationSteps):
     """A set of commands to safely migrate databases automatically"""
     def __init__(self,
                  out_of_order,
                  dry_run,
                  connection_string,
                  directory,
-                 run_for_new_db):
+                 run_for_new_db,
+                 pool_size=4):
         self.out_of_order = out_of_order
         self.dry_run = dry_run
+        self.connection_string = connection_string
         self.engine = DatabaseMigrationEngine.connect(connection_string)
         self.directory = directory
         self.run_for_new_db = run_for_new_db
+        self.pool_size = pool_size
 
 
     def blobsha1(self, filename):
-        """returns the git sha1sum of a file so the exact migration
-        that was run can easily be looked up in the git history"""
-        text = open(filename).read()
-        s = sha1(("blob %u\0" % len(text)).encode('UTF-8'))
-        s.update(text.encode('UTF-8'))
-        return s.hexdigest()
+        return blobsha1(filename)
 
     def current_migrations(self):
         """returns the current migration files as a list of
            (filename, sha1sum) tuples"""
-        return [
-            FilenameSha1(os.path.basename(filename), self.blobsha1(filename))
-            for filename in glob(os.path.join(self.directory, '*'))]
+        return directory_migrations(self.directory)
+
+    def write(self, message):
+        sys.stdout.write(message + "\n")
 
     def warn(self, message):
         sys.stderr.write(message + "\n")
@@ -69,82 +109,80 @@ class DBMigrate(object):
             new_filename = current_migrations.get(sha1)
             if sha1 in current_migrations and old_filename != new_filename:
                 renames.append(FilenameSha1(new_filename, sha1))
-        sql = '\n'.join(
-            "UPDATE dbmigration SET filename = '%(filename)s' "
-            "WHERE sha1 = '%(sha1)s';" % rename._asdict()
-            for rename in renames)
         if self.dry_run:
-            return sql
-        else:
-            self.engine.execute(sql)
+            return self.engine.rename_sql(renames) if renames else ''
+        if not renames:
+            return 'No renamed migrations'
+        start = time.time()
+        updated = self.engine.rename_migrations(renames)
+        return 'Renamed %d migrations (%d rows updated) in %.3fs' % (
+            len(renames), updated, time.time() - start)
+
+    @command
+    def plan(self, *args):
+        """print what migrate would do as JSON without changing anything"""
+        return self.migration_plan().to_json()
+
+    def migration_plan(self, current_migrations=None, engine=None,
+                       missing_table_ok=True):
+        """returns the MigrationPlan for the current migrations (the
+        directory by default) and the database"""
+        engine = engine or self.engine
+        if current_migrations is None:
+            current_migrations = self.current_migrations()
+        try:
+            performed_migrations = engine.performed_migrations
+        except SQLException as e:
+            performed_migrations = self.unread_migration_table(
+                e, missing_table_ok)
+        return self.plan_for(current_migrations, performed_migrations)
 
     @command
     def migrate(self, *args):
         """migrate a database to the current schema"""
+        return self.run_migrations(self.current_migrations())
+
+    def run_migrations(self, current_migrations, engine=None, sources=None,
+                       schema=None):
+        """migrate the database to the given list of (filename, sha1sum)
+        tuples. Script migrations get the schema in DBMIGRATE_SCHEMA."""
+        engine = engine or self.engine
+        env, warn = None, self.warn
+        if schema is not None:
+            env = dict(os.environ, DBMIGRATE_SCHEMA=schema)
+
+            def warn(message):
+                self.warn('[%s] %s' % (schema, message))
         new_db = False
         if not self.dry_run:
             try:
-                self.engine.create_migration_table()
+                engine.create_migration_table()
             except SQLException:
                 pass
             else:
                 new_db = True
-        try:
-            performed_migrations = self.engine.performed_migrations
-        except SQLException:
-            if self.dry_run:
-                performed_migrations = []
-            else:
-                raise
+        plan = self.migration_plan(current_migrations, engine,
+                                   missing_table_ok=self.dry_run)
+        files_sha1s_to_run = self.migrations_to_run(plan, warn)
 
-        current_migrations = self.current_migrations()
-        files_current = [x.filename for x in current_migrations]
-        files_performed = [x.filename for x in performed_migrations]
-        files_sha1s_to_run = (
-            set(current_migrations) - set(performed_migrations))
-        files_to_run = [x.filename for x in files_sha1s_to_run]
-        if len(files_performed):
-            latest_migration = max(files_performed)
-            old_unrun_migrations = list(filter(
-                lambda f: f < latest_migration, files_to_run))
-            if len(old_unrun_migrations):
-                if self.out_of_order:
-                    self.warn('Running [%s] out of order.' %
-                              ','.join(old_unrun_migrations))
-                else:
-                    raise OutOfOrderException(
-                        '[%s] older than the latest performed migration' %
-                        ','.join(old_unrun_migrations))
-        modified_migrations = set(files_to_run).intersection(files_performed)
-        if modified_migrations:
-            raise ModifiedMigrationException(
-                '[%s] migrations were modified since they were '
-                'run on this database.' % ','.join(modified_migrations))
-        deleted_migrations = (
-            set(files_performed + files_to_run) - set(files_current))
-        if deleted_migrations:
-            raise ModifiedMigrationException(
-                '[%s] migrations were deleted since they were '
-                'run on this database.' % ','.join(deleted_migrations))
-
-        migrations = [self.engine.sql(self.directory, filename, sha1_hash)
-                      for filename, sha1_hash in sorted(files_sha1s_to_run)]
+        migrations = [engine.sql(self.directory, filename, sha1_hash, sources)
+                      for filename, sha1_hash in files_sha1s_to_run]
 
         if self.dry_run:
             return '\n'.join(str(x) for x in migrations)
 
         for migration_info in migrations:
-            if not (new_db and not self.run_for_new_db):
+            if not self.simulate(new_db):
 
                 if migration_info.command:
-                    subprocess.check_call(migration_info.command)
+                    subprocess.check_call(migration_info.command, env=env)
 
                 if migration_info.migration_sql:
-                    self.engine.execute(migration_info.migration_sql)
+                    engine.execute(migration_info.migration_sql)
                 migration_info.applied = True
             else:
                 migration_info.ghost = True
-            self.engine.execute(migration_info.migration_info_sql)
+            engine.execute(migration_info.migration_info_sql)
 
         return self.generate_response(migrations, new_db)
 
@@ -165,6 +203,94 @@ class DBMigrate(object):
             response.append('\n'.join(x.filename for x in ghosts))
         return '\n'.join(response)
 
+    @command
+    def migrate_schemas(self, *schemas):
+        """migrate each of the given schemas (or LIKE patterns with %)"""
+        if not self.engine.supports_schemas:
+            raise SQLException(
+                '%s does not support schemas' % self.engine.SCHEME)
+        names = []
+        for schema in schemas:
+            if '%' in schema:
+                names.extend(self.engine.schemas(schema))
+            else:
+                names.append(schema)
+        # hash and read every migration once for all of the schemas
+        current_migrations = self.current_migrations()
+        sources = self.engine.read_sources(self.directory,
+                                           current_migrations)
+        pool = [self.engine]
+        failed = []
+        try:
+            # connect one at a time so a failed connect still closes the
+            # connections opened before it
+            while len(pool) < min(self.pool_size, len(names)):
+                pool.append(
+                    DatabaseMigrationEngine.connect(self.connection_string))
+            for start in range(0, len(names), len(pool)):
+                batch = names[start:start + len(pool)]
+                results = [None] * len(batch)
+
+                def run(index, engine, schema):
+                    # one schema failing for any reason must not stop
+                    # the others
+                    try:
+                        engine.set_schema(schema)
+                        results[index] = (True, self.run_migrations(
+                            current_migrations, engine, sources, schema))
+                    except Exception as e:
+                        results[index] = (False, str(e))
+
+                threads = [threading.Thread(target=run, args=args)
+                           for args in zip(range(len(batch)), pool, batch)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                for schema, (succeeded, result) in zip(batch, results):
+                    if succeeded:
+                        self.write('[%s] %s' % (schema, result.replace(
+                            '\n', '\n[%s] ' % schema)))
+                    else:
+                        failed.append(schema)
+                        self.warn('[%s] failed: %s' % (schema, result))
+        finally:
+            for engine in pool[1:]:
+                engine.close()
+            self.engine.reset_schema()
+        response = 'Migrated %d schemas' % (len(names) - len(failed))
+        if failed:
+            response += ', %d failed: %s' % (len(failed), ','.join(failed))
+        return response
+
+    @command
+    def watch(self, interval=1, debounce=0.5, polls=None, sleep=time.sleep):
+        """watch the directory and apply new migrations as they appear"""
+        watcher = MigrationWatcher(self.directory, self.blobsha1,
+                                   float(debounce))
+        watcher.load()
+        self.watch_migrate(watcher)
+        count = 0
+        try:
+            while polls is None or count < int(polls):
+                sleep(float(interval))
+                count += 1
+                if watcher.poll():
+                    self.watch_migrate(watcher)
+        except KeyboardInterrupt:
+            pass
+
+    def watch_migrate(self, watcher):
+        try:
+            result = self.run_migrations(watcher.current_migrations())
+        except Exception as e:
+            # keep watching whatever went wrong, e.g. a new script that
+            # isn't executable yet or a driver error from the engine
+            self.warn(str(e))
+        else:
+            if result:
+                self.write(result)
+
 
     @command
     def create(self, slug, ext="sql", open=open):
@@ -188,7 +314,7 @@ class DBMigrate(object):
 
 def main():
     usage = '\n'
-    for command_name, help in sorted(command.help.iteritems()):
+    for command_name, help in sorted(command.help.items()):
         usage += "%s - %s\n" % (command_name.rjust(15), help)
 
     parser = OptionParser(usage=usage)
@@ -214,6 +340,11 @@ def main():
     parser.add_option(
         "-r", "--run-for-new-db", dest="run_for_new_db", action="store_false",
         help="whether the existing migrations should be run if the migration table has been created")
+    parser.add_option(
+        "-p", "--pool-size", dest="pool_size", action="store",
+        help="number of connections used by migrate_schemas",
+        type="int",
+        default=4)
 
     (options, args) = parser.parse_args()
 
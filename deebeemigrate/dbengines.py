@@ -6,7 +6,10 @@ try:
     import json
 except ImportError:
     import simplejson as json
-from urlparse import urlsplit
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
 
 logger = logging.getLogger(__name__)
 
@@ -42,10 +45,32 @@ class MigrationCommandInfo(object):
 
 INSERT_STMT = "INSERT INTO dbmigration (filename, sha1, date) VALUES ('%s', '%s', %s());"
 
+
+def quote(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def quote_identifier(value):
+    return '"%s"' % value.replace('"', '""')
+
+
 class DatabaseMigrationEngine(object):
     migration_table_sql = (
         "CREATE TABLE dbmigration "
         "(filename varchar(255), sha1 varchar(40), date datetime);")
+    rename_table_sql = (
+        "CREATE TEMPORARY TABLE dbmigration_rename "
+        "(filename varchar(255), sha1 varchar(40) PRIMARY KEY);")
+    rename_insert_sql = (
+        "INSERT INTO dbmigration_rename (filename, sha1) "
+        "VALUES (%(param)s, %(param)s)")
+    rename_update_sql = (
+        "UPDATE dbmigration SET filename = ("
+        "SELECT dbmigration_rename.filename FROM dbmigration_rename "
+        "WHERE dbmigration_rename.sha1 = dbmigration.sha1) "
+        "WHERE sha1 IN (SELECT sha1 FROM dbmigration_rename);")
+    rename_drop_sql = "DROP TABLE IF EXISTS dbmigration_rename;"
+    supports_schemas = False
     ENGINES = {}
 
 
@@ -53,13 +78,26 @@ class DatabaseMigrationEngine(object):
         self.execute(self.migration_table_sql)
 
 
-    def sql(self, directory, filename, sha1_hash):
+    def read_sources(self, directory, migrations):
+        """returns a dict of filename -> contents of the sql migrations so
+        they can be passed to sql() instead of being read again"""
+        sources = {}
+        for filename, sha1_hash in migrations:
+            if os.path.splitext(filename)[-1] == '.sql':
+                with open(os.path.join(directory, filename), 'r') as migration:
+                    sources[filename] = migration.read()
+        return sources
+
+    def sql(self, directory, filename, sha1_hash, sources=None):
         command = None
         sql_statement = ''
 
         if os.path.splitext(filename)[-1] == '.sql':
-            with open(os.path.join(directory, filename), 'r') as migration:
-                sql_statement = migration.read()
+            if sources is not None and filename in sources:
+                sql_statement = sources[filename]
+            else:
+                with open(os.path.join(directory, filename), 'r') as migration:
+                    sql_statement = migration.read()
         else:
             command = os.path.join(directory, filename)
 
@@ -68,6 +106,52 @@ class DatabaseMigrationEngine(object):
                                     migration_info_sql=INSERT_STMT % (filename, sha1_hash, self.date_func),
                                     filename=filename)
 
+    def rename_migrations(self, renames):
+        """stages the (filename, sha1) renames in a temporary table and
+        applies them with a single UPDATE in one transaction. Returns the
+        number of rows in the migration table that were updated."""
+        cursor = self.connection.cursor()
+        try:
+            # a temporary table left over from a failed rename on this
+            # connection (sqlite and mysql keep it after a rollback)
+            cursor.execute(self.rename_drop_sql)
+            cursor.execute(self.rename_table_sql)
+            cursor.executemany(
+                self.rename_insert_sql % {'param': self.placeholder},
+                [tuple(rename) for rename in renames])
+            cursor.execute(self.rename_update_sql)
+            updated = cursor.rowcount
+            cursor.execute(self.rename_drop_sql)
+            self.connection.commit()
+        except self.Error as e:
+            self.connection.rollback()
+            raise SQLException(str(e))
+        return updated
+
+    def rename_sql(self, renames):
+        """returns the SQL rename_migrations would run for the renames"""
+        inserts = [(self.rename_insert_sql % {'param': '%s'}) %
+                   (quote(filename), quote(sha1)) + ';'
+                   for filename, sha1 in renames]
+        return '\n'.join([self.rename_drop_sql, self.rename_table_sql] +
+                         inserts +
+                         [self.rename_update_sql, self.rename_drop_sql])
+
+    def close(self):
+        self.connection.close()
+
+    def set_schema(self, schema):
+        """makes schema the one the migrations and dbmigration live in"""
+        raise SQLException('%s does not support schemas' % self.SCHEME)
+
+    def reset_schema(self):
+        """undoes set_schema"""
+        pass
+
+    def schemas(self, pattern):
+        """returns the names of the schemas matching a LIKE pattern"""
+        raise SQLException('%s does not support schemas' % self.SCHEME)
+
     @property
     def performed_migrations(self):
         return [FilenameSha1(r[0], r[1]) for r in self.results(
@@ -86,10 +170,14 @@ class DatabaseMigrationEngine(object):
 class sqlite(DatabaseMigrationEngine):
     """a migration engine for sqlite"""
     date_func = 'datetime'
+    placeholder = '?'
     SCHEME = 'sqlite'
 
     def __init__(self, db_data):
         self.connection = sqlite3.connect(db_data['database'])
+        self.Error = sqlite3.Error
+        self.ProgrammingError = sqlite3.ProgrammingError
+        self.OperationalError = sqlite3.OperationalError
 
     def execute(self, statement):
         try:
@@ -107,10 +195,12 @@ class sqlite(DatabaseMigrationEngine):
 class GenericEngine(DatabaseMigrationEngine):
     """a generic database engine"""
     date_func = 'now'
+    placeholder = '%s'
 
     def __init__(self, db_data):
         db_data.pop('engine')
         self.connection = self.engine.connect(**db_data)
+        self.Error = self.engine.Error
         self.ProgrammingError = self.engine.ProgrammingError
         self.OperationalError = self.engine.OperationalError
 
@@ -132,6 +222,13 @@ class mysql(GenericEngine):
 
     SCHEME = 'mysql'
 
+    # mysql can't refer to a temporary table twice in one query
+    rename_update_sql = (
+        "UPDATE dbmigration INNER JOIN dbmigration_rename "
+        "ON dbmigration.sha1 = dbmigration_rename.sha1 "
+        "SET dbmigration.filename = dbmigration_rename.filename;")
+    rename_drop_sql = "DROP TEMPORARY TABLE IF EXISTS dbmigration_rename;"
+
     def __init__(self, db_data):
         import MySQLdb
         self.engine = MySQLdb
@@ -145,6 +242,12 @@ class postgresql(GenericEngine):
         "CREATE TABLE dbmigration "
         "(filename varchar(255), sha1 varchar(40), date timestamp);")
 
+    rename_update_sql = (
+        "UPDATE dbmigration SET filename = dbmigration_rename.filename "
+        "FROM dbmigration_rename "
+        "WHERE dbmigration.sha1 = dbmigration_rename.sha1;")
+    supports_schemas = True
+
     SCHEME = 'postgresql'
 
     def __init__(self, db_data):
@@ -152,6 +255,18 @@ class postgresql(GenericEngine):
         self.engine = psycopg2
         super(postgresql, self).__init__(db_data)
 
+    def set_schema(self, schema):
+        self.execute('SET search_path TO %s;' % quote_identifier(schema))
+
+    def reset_schema(self):
+        self.execute('RESET search_path;')
+
+    def schemas(self, pattern):
+        return [r[0] for r in self.results(
+            "SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name LIKE %s ORDER BY schema_name;" %
+            quote(pattern))]
+
     def execute(self, statement):
         try:
             c = self.connection.cursor()
@@ -0,0 +1,72 @@
+from bisect import bisect_left
+from operator import itemgetter
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class OutOfOrderException(Exception):
+    pass
+
+
+class ModifiedMigrationException(Exception):
+    pass
+
+
+class MigrationPlan(object):
+    """What migrate would do for a set of current and performed migrations,
+    computed without touching the database or the migration files.
+
+    to_run is the sorted list of (filename, sha1sum) tuples that have not
+    been run, out_of_order, modified and deleted are sorted filenames."""
+
+    __slots__ = ('to_run', 'out_of_order', 'modified', 'deleted')
+
+    def __init__(self, current_migrations, performed_migrations):
+        filename = itemgetter(0)
+        self.to_run = sorted(
+            set(current_migrations).difference(performed_migrations))
+        files_to_run = list(map(filename, self.to_run))
+        files_performed = set(map(filename, performed_migrations))
+        if files_performed:
+            # files_to_run is sorted so everything older than the latest
+            # performed migration is a prefix of it
+            self.out_of_order = files_to_run[
+                :bisect_left(files_to_run, max(files_performed))]
+        else:
+            self.out_of_order = []
+        self.modified = [f for f in files_to_run if f in files_performed]
+        self.deleted = sorted(
+            files_performed.difference(map(filename, current_migrations)))
+
+    def check(self, out_of_order, warn):
+        """raises if performed migrations were modified or deleted or if
+        new migrations are out of order and out_of_order is not set.
+        Returns the migrations to run."""
+        if self.out_of_order:
+            if out_of_order:
+                warn('Running [%s] out of order.' %
+                     ','.join(self.out_of_order))
+            else:
+                raise OutOfOrderException(
+                    '[%s] older than the latest performed migration' %
+                    ','.join(self.out_of_order))
+        if self.modified:
+            raise ModifiedMigrationException(
+                '[%s] migrations were modified since they were '
+                'run on this database.' % ','.join(self.modified))
+        if self.deleted:
+            raise ModifiedMigrationException(
+                '[%s] migrations were deleted since they were '
+                'run on this database.' % ','.join(self.deleted))
+        return self.to_run
+
+    def as_dict(self):
+        return {'to_run': [list(m) for m in self.to_run],
+                'out_of_order': self.out_of_order,
+                'modified': self.modified,
+                'deleted': self.deleted}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
@@ -0,0 +1,5 @@
+# async syntax lives here so test_aio can be collected on python 2
+
+
+async def collect(events):
+    return [event async for event in events]
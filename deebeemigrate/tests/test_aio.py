@@ -0,0 +1,91 @@
+from deebeemigrate.core import DBMigrate, OutOfOrderException
+from deebeemigrate.dbengines import SQLException
+import os
+import sys
+
+import unittest
+
+ASYNCIO = sys.version_info >= (3, 7)
+if ASYNCIO:
+    import asyncio
+    from deebeemigrate.aio import AsyncDBMigrate, MigrationEvent
+    from deebeemigrate.tests.async_helpers import collect
+
+
+def fixture_path(name):
+    return os.path.join(os.path.dirname(__file__), 'fixtures', name)
+
+
+@unittest.skipUnless(ASYNCIO, 'deebeemigrate.aio needs python 3.7+')
+class TestAsyncDBMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'out_of_order': False,
+            'dry_run': False,
+            'connection_string': 'sqlite:///:memory:',
+            'run_for_new_db': True
+        }
+
+    def run_migrate(self, dbmigrate):
+        return asyncio.run(collect(dbmigrate.migrate()))
+
+    def performed_migrations(self, dbmigrate):
+        return asyncio.run(dbmigrate.engine.performed_migrations())
+
+    def test_migrate_events(self):
+        self.settings['directory'] = fixture_path('second-run')
+        dbmigrate = AsyncDBMigrate(**self.settings)
+        self.assertEqual(self.run_migrate(dbmigrate), [
+            MigrationEvent('created_table', None, None),
+            MigrationEvent('applied', '20120115075349-create-user-table.sql',
+                           None),
+            MigrationEvent('applied', '20120603133552-awesome.sql', None),
+            MigrationEvent('done', None, 2)])
+        self.assertEqual(
+            self.performed_migrations(dbmigrate),
+            [('20120115075349-create-user-table.sql',
+              '0187aa5e13e268fc621c894a7ac4345579cf50b7'),
+             ('20120603133552-awesome.sql',
+              '6759512e1e29b60a82b4a5587c5ea18e06b7d381')])
+        self.assertEqual(self.run_migrate(dbmigrate),
+                         [MigrationEvent('done', None, 0)])
+
+    def test_dry_run_migrate(self):
+        self.settings['directory'] = fixture_path('initial')
+        self.settings['dry_run'] = True
+        dbmigrate = AsyncDBMigrate(**self.settings)
+        events = self.run_migrate(dbmigrate)
+        self.assertEqual([event.kind for event in events], ['planned', 'done'])
+        self.assertTrue(events[0].detail.startswith(
+            'sql: -- intentionally making this imperfect'))
+
+    def test_simulated_for_new_db(self):
+        self.settings['directory'] = fixture_path('initial')
+        self.settings['run_for_new_db'] = False
+        dbmigrate = AsyncDBMigrate(**self.settings)
+        self.assertEqual(
+            [event.kind for event in self.run_migrate(dbmigrate)],
+            ['created_table', 'simulated', 'done'])
+
+    def test_out_of_order_migration(self):
+        self.settings['directory'] = fixture_path('out-of-order-1')
+        dbmigrate = AsyncDBMigrate(**self.settings)
+        self.run_migrate(dbmigrate)
+        dbmigrate.directory = fixture_path('out-of-order-2')
+        self.assertRaises(OutOfOrderException, self.run_migrate, dbmigrate)
+        dbmigrate.out_of_order = True
+        self.assertEqual(
+            self.run_migrate(dbmigrate)[0],
+            MigrationEvent('warning', None,
+                           'Running [20120114221757-before-initial.sql] '
+                           'out of order.'))
+
+    def test_migration_plan_matches_dbmigrate(self):
+        self.settings['directory'] = fixture_path('second-run')
+        dbmigrate = AsyncDBMigrate(**self.settings)
+        plan = asyncio.run(dbmigrate.migration_plan())
+        self.assertEqual(plan.as_dict(),
+                         DBMigrate(**self.settings).migration_plan().as_dict())
+        self.assertRaises(SQLException, asyncio.run,
+                          dbmigrate.migration_plan(missing_table_ok=False))
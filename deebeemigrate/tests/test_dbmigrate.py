@@ -1,9 +1,18 @@
 from deebeemigrate.core import (
     DBMigrate, OutOfOrderException, ModifiedMigrationException
 )
-from deebeemigrate.dbengines import parse_db_url
+from deebeemigrate.dbengines import (
+    DatabaseMigrationEngine, FilenameSha1, SQLException, parse_db_url,
+    postgresql, sqlite
+)
+from deebeemigrate.plan import MigrationPlan
+from fnmatch import fnmatch
+import sqlite3
 import subprocess
 import os
+import shutil
+import tempfile
+import time
 
 import unittest
 
@@ -48,6 +57,38 @@ class TestConnectionUrlParser(unittest.TestCase):
                               password=None,
                               database=':memory:'))
 
+class tenantsqlite(sqlite):
+    """a sqlite engine that fakes postgres schemas with one in-memory
+    database per schema, shared by every connection"""
+    SCHEME = 'tenantsqlite'
+    supports_schemas = True
+    SCHEMAS = ['other', 'tenant_a', 'tenant_b', 'tenant_c']
+
+    def __init__(self, db_data):
+        super(tenantsqlite, self).__init__(db_data)
+        self.default_connection = self.connection
+
+    def set_schema(self, schema):
+        if schema not in self.databases:
+            self.databases[schema] = sqlite3.connect(
+                ':memory:', check_same_thread=False)
+        self.connection = self.databases[schema]
+
+    def reset_schema(self):
+        self.connection = self.default_connection
+
+    def schemas(self, pattern):
+        return [schema for schema in self.SCHEMAS
+                if fnmatch(schema, pattern.replace('%', '*'))]
+
+    def close(self):
+        pass
+
+
+def fixture_path(name):
+    return os.path.join(os.path.dirname(__file__), 'fixtures', name)
+
+
 class TestDBMigrate(unittest.TestCase):
 
     def setUp(self):
@@ -314,3 +355,359 @@ migration info: INSERT INTO dbmigration (filename, sha1, date) VALUES ('20120603
               '4aebd2514665effff5105ad568a4fbe62f567087'),
              ('20120115075349-create-user-table.sql',
               '0187aa5e13e268fc621c894a7ac4345579cf50b7')])
+
+    def copy_fixture(self, fixture):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for filename in os.listdir(fixture_path(fixture)):
+            shutil.copy(os.path.join(fixture_path(fixture), filename),
+                        directory)
+        return directory
+
+    def test_watch_applies_new_migrations(self):
+        directory = self.copy_fixture('initial')
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        output = []
+        dbmigrate.write = output.append
+        polls = []
+
+        def sleep(interval):
+            polls.append(interval)
+            if len(polls) == 1:
+                shutil.copy(os.path.join(fixture_path('second-run'),
+                                         '20120603133552-awesome.sql'),
+                            directory)
+
+        dbmigrate.watch(debounce=0, polls=3, sleep=sleep)
+        self.assertEqual(len(polls), 3)
+        self.assertEqual(
+            output,
+            ['Created migrations table\nRan 1 migrations:\n'
+             '20120115075349-create-user-table.sql',
+             'Ran 1 migrations:\n20120603133552-awesome.sql'])
+        self.assertEqual(
+            dbmigrate.engine.performed_migrations,
+            [('20120115075349-create-user-table.sql',
+              '0187aa5e13e268fc621c894a7ac4345579cf50b7'),
+             ('20120603133552-awesome.sql',
+              '6759512e1e29b60a82b4a5587c5ea18e06b7d381')])
+
+    def test_watch_ignores_unsettled_files(self):
+        directory = self.copy_fixture('initial')
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        output = []
+        dbmigrate.write = output.append
+        path = os.path.join(directory, '20120603133552-awesome.sql')
+        polls = []
+
+        def sleep(interval):
+            # the file keeps growing on every poll
+            polls.append(interval)
+            open(path, 'w').write('-- half saved' * len(polls))
+
+        dbmigrate.watch(debounce=0, polls=3, sleep=sleep)
+        self.assertEqual(len(output), 1)
+        self.assertEqual(
+            [x.filename for x in dbmigrate.engine.performed_migrations],
+            ['20120115075349-create-user-table.sql'])
+
+    def test_watch_reports_modified_migrations(self):
+        directory = self.copy_fixture('modified-1')
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.write = lambda message: None
+        warnings = []
+        dbmigrate.warn = warnings.append
+        polls = []
+
+        def sleep(interval):
+            polls.append(interval)
+            if len(polls) == 1:
+                shutil.copy(os.path.join(fixture_path('modified-2'),
+                                         '20120115221757-initial.sql'),
+                            directory)
+
+        dbmigrate.watch(debounce=0, polls=3, sleep=sleep)
+        self.assertEqual(
+            warnings,
+            ['[20120115221757-initial.sql] migrations were '
+             'modified since they were run on this database.'])
+
+    def test_watch_survives_non_executable_scripts(self):
+        directory = self.copy_fixture('initial')
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        output, warnings, polls = [], [], []
+        dbmigrate.write = output.append
+        dbmigrate.warn = warnings.append
+        path = os.path.join(directory, '20120603133552-script.sh')
+
+        def sleep(interval):
+            polls.append(interval)
+            if len(polls) == 1:
+                open(path, 'w').write('#!/bin/sh\n')
+                os.chmod(path, 0o644)
+            elif len(polls) == 3:
+                os.chmod(path, 0o755)
+
+        dbmigrate.watch(debounce=0, polls=5, sleep=sleep)
+        self.assertEqual(len(warnings), 1)
+        self.assertTrue('Permission denied' in warnings[0], warnings)
+        self.assertEqual(output[-1],
+                         'Ran 1 migrations:\n20120603133552-script.sh')
+
+    def test_renamed_reports_count(self):
+        self.settings['directory'] = fixture_path('sha1-update-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.migrate()
+        dbmigrate.directory = fixture_path('sha1-update-2')
+        result = dbmigrate.renamed()
+        self.assertTrue(
+            result.startswith('Renamed 1 migrations (1 rows updated) in '),
+            result)
+        self.assertEqual(dbmigrate.renamed(), 'No renamed migrations')
+
+    def test_many_renames(self):
+        # the staging table is keyed on sha1, without the key every
+        # updated row scans it and this takes seconds
+        self.settings['directory'] = fixture_path('initial')
+        dbmigrate = DBMigrate(**self.settings)
+        engine = dbmigrate.engine
+        engine.create_migration_table()
+        engine.connection.executemany(
+            'INSERT INTO dbmigration VALUES (?, ?, datetime())',
+            [('%05d-old.sql' % i, '%040x' % i) for i in range(10000)])
+        engine.connection.commit()
+        start = time.time()
+        updated = engine.rename_migrations(
+            [FilenameSha1('%05d-new.sql' % i, '%040x' % i)
+             for i in range(10000)])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(updated, 10000)
+        self.assertEqual(engine.performed_migrations[-1],
+                         ('09999-new.sql', '%040x' % 9999))
+
+    def test_failed_rename_can_be_retried(self):
+        self.settings['directory'] = fixture_path('sha1-update-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.migrate()
+        self.assertRaises(SQLException, dbmigrate.engine.rename_migrations,
+                          [FilenameSha1(object(), 'bad')])
+        dbmigrate.directory = fixture_path('sha1-update-2')
+        self.assertTrue(dbmigrate.renamed().startswith('Renamed 1 migrations'))
+
+    def test_dry_run_renamed(self):
+        self.settings['directory'] = fixture_path('sha1-update-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.migrate()
+        dbmigrate.directory = fixture_path('sha1-update-2')
+        dbmigrate.dry_run = True
+        sql = dbmigrate.renamed()
+        self.assertTrue(sql.startswith(
+            'DROP TABLE IF EXISTS dbmigration_rename;\n'
+            'CREATE TEMPORARY TABLE dbmigration_rename'))
+        self.assertTrue(
+            "INSERT INTO dbmigration_rename (filename, sha1) VALUES ("
+            "'20120115075300-add-another-test-table-renamed-reordered.sql', "
+            "'4aebd2514665effff5105ad568a4fbe62f567087');" in sql, sql)
+        self.assertTrue(sql.endswith('DROP TABLE IF EXISTS dbmigration_rename;'))
+        self.assertEqual(
+            [x.filename for x in dbmigrate.engine.performed_migrations],
+            ['20120115075349-create-user-table.sql',
+             '20121024124204-add-another-test-table.sql'])
+
+    def register_tenant_engine(self):
+        """registers a tenantsqlite engine with fresh schemas for one test"""
+        engine = type('tenantsqlite', (tenantsqlite,), {'databases': {}})
+        engine.register()
+        self.addCleanup(DatabaseMigrationEngine.ENGINES.pop, engine.SCHEME)
+        self.settings['connection_string'] = 'tenantsqlite:///:memory:'
+        return engine
+
+    def test_migrate_schemas(self):
+        self.register_tenant_engine()
+        self.settings['directory'] = fixture_path('second-run')
+        self.settings['pool_size'] = 2
+        dbmigrate = DBMigrate(**self.settings)
+        output = []
+        dbmigrate.write = output.append
+        self.assertEqual(dbmigrate.migrate_schemas('tenant_%', 'other'),
+                         'Migrated 4 schemas')
+        self.assertEqual(len(output), 4)
+        self.assertTrue(
+            dbmigrate.engine.connection is dbmigrate.engine.default_connection)
+        for schema in tenantsqlite.SCHEMAS:
+            dbmigrate.engine.set_schema(schema)
+            self.assertEqual(
+                [x.filename for x in dbmigrate.engine.performed_migrations],
+                ['20120115075349-create-user-table.sql',
+                 '20120603133552-awesome.sql'])
+        self.assertEqual(dbmigrate.migrate_schemas('tenant_%'),
+                         'Migrated 3 schemas')
+
+    def test_migrate_schemas_reports_failures(self):
+        self.register_tenant_engine()
+        self.settings['directory'] = fixture_path('modified-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.write = lambda message: None
+        dbmigrate.migrate_schemas('tenant_b')
+        dbmigrate.directory = fixture_path('modified-2')
+        warnings = []
+        dbmigrate.warn = warnings.append
+        self.assertEqual(dbmigrate.migrate_schemas('tenant_%'),
+                         'Migrated 2 schemas, 1 failed: tenant_b')
+        self.assertEqual(
+            warnings,
+            ['[tenant_b] failed: [20120115221757-initial.sql] migrations '
+             'were modified since they were run on this database.'])
+
+    def test_migrate_schemas_reports_unexpected_errors(self):
+        self.register_tenant_engine()
+        directory = self.copy_fixture('initial')
+        path = os.path.join(directory, '20120603133552-script.sh')
+        open(path, 'w').write('#!/bin/sh\n')
+        os.chmod(path, 0o644)
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        warnings = []
+        dbmigrate.warn = warnings.append
+        self.assertEqual(
+            dbmigrate.migrate_schemas('tenant_%'),
+            'Migrated 0 schemas, 3 failed: tenant_a,tenant_b,tenant_c')
+        self.assertTrue('Permission denied' in warnings[0], warnings)
+
+    def test_migrate_schemas_passes_schema_to_scripts(self):
+        self.register_tenant_engine()
+        ran = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ran)
+        directory = self.copy_fixture('initial')
+        path = os.path.join(directory, '20120603133552-script.sh')
+        open(path, 'w').write('#!/bin/sh\ntouch %s/$DBMIGRATE_SCHEMA\n' % ran)
+        os.chmod(path, 0o755)
+        self.settings['directory'] = directory
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.write = lambda message: None
+        self.assertEqual(dbmigrate.migrate_schemas('tenant_%'),
+                         'Migrated 3 schemas')
+        self.assertEqual(sorted(os.listdir(ran)),
+                         ['tenant_a', 'tenant_b', 'tenant_c'])
+
+    def test_postgresql_schema_sql(self):
+        # postgresql.__init__ needs psycopg2 so only the SQL is checked
+        engine = postgresql.__new__(postgresql)
+        statements = []
+        engine.execute = statements.append
+
+        def results(statement):
+            statements.append(statement)
+            return [('tenant_a',), ('tenant_b',)]
+        engine.results = results
+        engine.set_schema('tenant "a"')
+        engine.reset_schema()
+        self.assertEqual(engine.schemas("tenant's_%"),
+                         ['tenant_a', 'tenant_b'])
+        self.assertEqual(statements, [
+            'SET search_path TO "tenant ""a""";',
+            'RESET search_path;',
+            "SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name LIKE 'tenant''s_%' ORDER BY schema_name;"])
+
+    def test_migrate_schemas_unsupported(self):
+        self.settings['directory'] = fixture_path('initial')
+        dbmigrate = DBMigrate(**self.settings)
+        self.assertRaises(SQLException, dbmigrate.migrate_schemas, 'tenant_%')
+        self.assertRaises(SQLException, dbmigrate.migrate_schemas,
+                          'tenant_a', 'tenant_b')
+
+    def test_migrate_schemas_prefixes_warnings(self):
+        self.register_tenant_engine()
+        self.settings['directory'] = fixture_path('out-of-order-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.write = lambda message: None
+        dbmigrate.migrate_schemas('tenant_a')
+        dbmigrate.directory = fixture_path('out-of-order-2')
+        dbmigrate.out_of_order = True
+        warnings = []
+        dbmigrate.warn = warnings.append
+        self.assertEqual(dbmigrate.migrate_schemas('tenant_%'),
+                         'Migrated 3 schemas')
+        self.assertEqual(
+            warnings,
+            ['[tenant_a] Running [20120114221757-before-initial.sql] '
+             'out of order.'])
+
+    def test_migrate_schemas_closes_pool_when_connect_fails(self):
+        engine = self.register_tenant_engine()
+        opened, closed = [], []
+
+        class failing(engine):
+            def __init__(self, db_data):
+                if len(opened) == 2:
+                    raise SQLException('too many connections')
+                super(failing, self).__init__(db_data)
+                opened.append(self)
+
+            def close(self):
+                closed.append(self)
+        failing.register()
+        self.settings['directory'] = fixture_path('initial')
+        dbmigrate = DBMigrate(**self.settings)
+        self.assertRaises(SQLException, dbmigrate.migrate_schemas, 'tenant_%')
+        self.assertEqual(closed, [opened[1]])
+
+    def test_plan(self):
+        self.settings['directory'] = fixture_path('initial')
+        dbmigrate = DBMigrate(**self.settings)
+        self.assertEqual(
+            dbmigrate.plan(),
+            '{"deleted": [], "modified": [], "out_of_order": [], '
+            '"to_run": [["20120115075349-create-user-table.sql", '
+            '"0187aa5e13e268fc621c894a7ac4345579cf50b7"]]}')
+        # planning has no side effects
+        self.assertRaises(SQLException,
+                          lambda: dbmigrate.engine.performed_migrations)
+        dbmigrate.migrate()
+        self.assertEqual(dbmigrate.migration_plan().to_run, [])
+
+    def test_plan_detects_problems(self):
+        self.settings['directory'] = fixture_path('out-of-order-1')
+        dbmigrate = DBMigrate(**self.settings)
+        dbmigrate.migrate()
+        dbmigrate.directory = fixture_path('out-of-order-2')
+        plan = dbmigrate.migration_plan()
+        self.assertEqual(plan.out_of_order,
+                         ['20120114221757-before-initial.sql'])
+        self.assertEqual(plan.modified, [])
+        dbmigrate.directory = fixture_path('modified-2')
+        self.assertEqual(dbmigrate.migration_plan().modified,
+                         ['20120115221757-initial.sql'])
+        dbmigrate.directory = fixture_path('deleted-2')
+        self.assertEqual(dbmigrate.migration_plan().deleted,
+                         ['20120115221757-initial.sql'])
+        self.assertEqual(
+            dbmigrate.migration_plan([FilenameSha1('a.sql', 'a')]).to_run,
+            [('a.sql', 'a')])
+
+
+class TestMigrationPlan(unittest.TestCase):
+
+    def test_out_of_order_is_strictly_older(self):
+        performed = [FilenameSha1('2', 'b'), FilenameSha1('4', 'd')]
+        current = performed + [FilenameSha1('1', 'a'), FilenameSha1('3', 'c'),
+                               FilenameSha1('5', 'e')]
+        plan = MigrationPlan(current, performed)
+        self.assertEqual(plan.out_of_order, ['1', '3'])
+        self.assertEqual(plan.to_run, [('1', 'a'), ('3', 'c'), ('5', 'e')])
+        self.assertRaises(OutOfOrderException, plan.check, False, None)
+        warnings = []
+        self.assertEqual(plan.check(True, warnings.append), plan.to_run)
+        self.assertEqual(warnings, ['Running [1,3] out of order.'])
+
+    def test_empty_history(self):
+        plan = MigrationPlan([FilenameSha1('1', 'a')], [])
+        self.assertEqual(plan.as_dict(), {'to_run': [['1', 'a']],
+                                          'out_of_order': [],
+                                          'modified': [],
+                                          'deleted': []})
@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+from glob import glob
+
+from deebeemigrate.dbengines import FilenameSha1
+
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationWatcher(object):
+    """Keeps an in-memory manifest of the migrations in a directory and
+    reports which files changed since the last poll.
+
+    Changes are detected with os.stat so no OS-specific notifier is
+    needed. A changed file is only hashed and reported once its stat has
+    stayed the same for `debounce` seconds so half-saved files are
+    ignored."""
+
+    def __init__(self, directory, blobsha1, debounce=0.5, clock=time.time):
+        self.directory = directory
+        self.blobsha1 = blobsha1
+        self.debounce = debounce
+        self.clock = clock
+        # filename -> FilenameSha1 of every settled migration
+        self.manifest = {}
+        # filename -> (mtime, size, mode) the manifest entry was hashed at
+        self.stats = {}
+        # filename -> ((mtime, size, mode), first time that stat was seen)
+        self.pending = {}
+
+    def scan(self):
+        """returns a dict of filename -> (mtime, size, mode) for the
+        directory"""
+        stats = {}
+        for path in glob(os.path.join(self.directory, '*')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed between the glob and the stat
+                continue
+            stats[os.path.basename(path)] = (
+                st.st_mtime, st.st_size, st.st_mode)
+        return stats
+
+    def load(self):
+        """hashes every migration in the directory without debouncing"""
+        self.manifest, self.stats, self.pending = {}, {}, {}
+        for filename, stat in self.scan().items():
+            self.settle(filename, stat)
+
+    def settle(self, filename, stat):
+        self.pending.pop(filename, None)
+        self.stats[filename] = stat
+        self.manifest[filename] = FilenameSha1(
+            filename, self.blobsha1(os.path.join(self.directory, filename)))
+
+    def poll(self):
+        """updates the manifest and returns the sorted list of filenames
+        that were added, modified or deleted since the last poll"""
+        now = self.clock()
+        stats = self.scan()
+        changed = []
+        for filename in set(self.manifest) - set(stats):
+            del self.manifest[filename]
+            del self.stats[filename]
+            changed.append(filename)
+        for filename in set(self.pending) - set(stats):
+            del self.pending[filename]
+        for filename, stat in stats.items():
+            if self.stats.get(filename) == stat:
+                self.pending.pop(filename, None)
+                continue
+            pending_stat, since = self.pending.get(filename, (None, None))
+            if pending_stat != stat:
+                self.pending[filename] = (stat, now)
+            elif now - since >= self.debounce:
+                old = self.manifest.get(filename)
+                old_stat = self.stats.get(filename, (None, None, None))
+                self.settle(filename, stat)
+                # touching a file without changing it is not a change but
+                # making a script executable is
+                if self.manifest[filename] != old or old_stat[2] != stat[2]:
+                    changed.append(filename)
+        return sorted(changed)
+
+    def current_migrations(self):
+        """returns the manifest as a list of (filename, sha1sum) tuples"""
+        return [self.manifest[filename] for filename in sorted(self.manifest)]
@@ -9,4 +9,10 @@ setup(
     author_email='dan.bravender@gmail.com',
     entry_points={'console_scripts': ['deebeemigrate = deebeemigrate.core:main']},
     packages=['deebeemigrate'],
+    # deebeemigrate.aio (AsyncDBMigrate) needs python 3.7+
+    classifiers=[
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+    ],
 )